@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+from pathlib import Path
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE = ("text/", "image/svg+xml", "application/javascript", "application/json")
+
+
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    """Encodings of an Accept-Encoding header, without those refused with q=0"""
+    encodings = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip().removeprefix("q=")
+        try:
+            if params and float(q) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+class Asset:
+    """File content with its precompressed variants"""
+
+    def __init__(self, content: bytes, media_type: str):
+        self.media_type = media_type
+        self.digest = hashlib.sha256(content).hexdigest()
+        self.variants = {"identity": content}
+        if media_type.startswith(COMPRESSIBLE):
+            compressed = {"gzip": gzip.compress(content, 9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(content, quality=11)
+            for encoding, data in compressed.items():
+                if len(data) < len(content):
+                    self.variants[encoding] = data
+
+    def etag(self, encoding) -> str:
+        return f'"{self.digest[:16]}-{encoding}"'
+
+    def select(self, accept_encoding: str) -> str:
+        accepted = accepted_encodings(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        encoding = self.select(request.headers.get("accept-encoding", ""))
+        headers = {
+            "Cache-Control": cache_control,
+            "ETag": self.etag(encoding),
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = request.headers.get("if-none-match", "")
+        if self.digest[:16] in if_none_match or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(
+            self.variants[encoding], media_type=self.media_type, headers=headers
+        )
+
+
+class AssetPipeline:
+    """Precompressed and fingerprinted static files, built once at startup.
+
+    Static files are served under /assets/ with their content hash in their
+    name, so they can be cached forever. HTML pages reference them by these
+    names and are revalidated with their ETag.
+    """
+
+    def __init__(self, directory="static", pages=None, aliases=None):
+        self.directory = Path(directory)
+        # Route -> HTML file
+        self.page_files = pages or {}
+        # Public url -> file, in addition to /static/<path>
+        self.aliases = aliases or {}
+        self.assets: dict[str, Asset] = {}
+        self.urls: dict[str, str] = {}
+        self.legacy: dict[str, Asset] = {}
+        self.pages: dict[str, Asset] = {}
+        self.build()
+
+    def _fingerprinted(self, path: Path, asset: Asset) -> str:
+        return path.with_name(f"{path.stem}.{asset.digest[:10]}{path.suffix}").as_posix()
+
+    def build(self):
+        page_paths = {self.directory / name for name in self.page_files.values()}
+        by_path = {}
+        for path in sorted(self.directory.rglob("*")):
+            relative = path.relative_to(self.directory)
+            if not path.is_file() or path in page_paths:
+                continue
+            if any(part.startswith(".") for part in relative.parts):
+                continue
+            media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+            asset = Asset(path.read_bytes(), media_type)
+            name = self._fingerprinted(relative, asset)
+            self.assets[name] = asset
+            by_path[relative] = (asset, f"/assets/{name}")
+        for url, file in (
+            *((f"/static/{relative.as_posix()}", relative) for relative in by_path),
+            *((url, Path(file)) for url, file in self.aliases.items()),
+        ):
+            asset, fingerprinted_url = by_path[file]
+            self.legacy[url] = asset
+            self.urls[url] = fingerprinted_url
+        for route, file in self.page_files.items():
+            html = (self.directory / file).read_text()
+            for url, fingerprinted_url in self.urls.items():
+                html = html.replace(f'"{url}"', f'"{fingerprinted_url}"')
+            self.pages[route] = Asset(html.encode(), "text/html")
+        encodings = "br, gzip" if brotli is not None else "gzip"
+        logger.info(f"{len(self.assets)} static assets precompressed with {encodings}")
@@ -0,0 +1,203 @@
+"""Minimal MQTT 3.1.1 broker, a stand-in to run several Eplumber nodes locally.
+
+Supports retained messages, last wills, wildcards and keepalive. Messages are
+delivered with QoS 0. Not meant for production, use mosquitto instead.
+"""
+
+import argparse
+import asyncio
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = range(1, 8)
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(8, 15)
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split("/")
+    levels = topic.split("/")
+    if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+        return False
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(levels) or (level != "+" and level != levels[i]):
+            return False
+    return len(levels) == len(filter_levels)
+
+
+def encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        encoded.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def encode_str(value: bytes) -> bytes:
+    return struct.pack("!H", len(value)) + value
+
+
+def packet(packet_type: int, flags: int, body: bytes = b"") -> bytes:
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+class Reader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def u8(self) -> int:
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def u16(self) -> int:
+        self.pos += 2
+        return struct.unpack_from("!H", self.data, self.pos - 2)[0]
+
+    def bytes(self) -> bytes:
+        length = self.u16()
+        self.pos += length
+        return self.data[self.pos - length : self.pos]
+
+    def str(self) -> str:
+        return self.bytes().decode()
+
+    def rest(self) -> bytes:
+        return self.data[self.pos :]
+
+    def more(self) -> bool:
+        return self.pos < len(self.data)
+
+
+class Client:
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = ""
+        self.subscriptions: set[str] = set()
+        self.will: tuple[str, bytes, bool] | None = None
+        self.keepalive = 0
+
+    def send(self, data: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class Broker:
+    def __init__(self):
+        self.clients: set[Client] = set()
+        self.retained: dict[str, bytes] = {}
+
+    def publish(self, topic: str, payload: bytes, retain=False):
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        data = packet(PUBLISH, 0, encode_str(topic.encode()) + payload)
+        for client in self.clients:
+            if any(topic_matches(f, topic) for f in client.subscriptions):
+                client.send(data)
+
+    async def read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True:
+            digit = (await reader.readexactly(1))[0]
+            length += (digit & 0x7F) * multiplier
+            multiplier *= 128
+            if not digit & 0x80:
+                break
+        return header[0] >> 4, header[0] & 0x0F, await reader.readexactly(length)
+
+    async def handle(self, reader, writer):
+        client = Client(writer)
+        try:
+            while True:
+                # Keepalive: drop clients silent for 1.5 keepalive periods
+                timeout = client.keepalive * 1.5 or None
+                packet_type, flags, body = await asyncio.wait_for(
+                    self.read_packet(reader), timeout
+                )
+                if self.dispatch(client, packet_type, flags, Reader(body)):
+                    client.will = None
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, TimeoutError, ConnectionError) as e:
+            logger.info(f"Client {client.client_id} lost: {type(e).__name__}")
+        finally:
+            self.clients.discard(client)
+            if client.will:
+                self.publish(*client.will)
+            writer.close()
+
+    def dispatch(self, client, packet_type, flags, body) -> bool:
+        """Handle a packet, return True on disconnect"""
+        if packet_type == CONNECT:
+            body.str(), body.u8()  # protocol name and level
+            connect_flags = body.u8()
+            client.keepalive = body.u16()
+            client.client_id = body.str()
+            if connect_flags & 0x04:
+                topic, payload = body.str(), body.bytes()
+                client.will = (topic, payload, bool(connect_flags & 0x20))
+            self.clients.add(client)
+            logger.info(f"Client {client.client_id} connected")
+            client.send(packet(CONNACK, 0, b"\x00\x00"))
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic = body.str()
+            packet_id = body.u16() if qos else None
+            self.publish(topic, body.rest(), retain=bool(flags & 0x01))
+            if qos == 1:
+                client.send(packet(PUBACK, 0, struct.pack("!H", packet_id)))
+            elif qos == 2:
+                client.send(packet(PUBREC, 0, struct.pack("!H", packet_id)))
+        elif packet_type == PUBREL:
+            client.send(packet(PUBCOMP, 0, struct.pack("!H", body.u16())))
+        elif packet_type == SUBSCRIBE:
+            packet_id = body.u16()
+            topic_filters = []
+            while body.more():
+                topic_filters.append(body.str())
+                body.u8()  # requested QoS, always granted 0
+            client.subscriptions.update(topic_filters)
+            granted = bytes(len(topic_filters))
+            client.send(packet(SUBACK, 0, struct.pack("!H", packet_id) + granted))
+            for topic, payload in self.retained.items():
+                if any(topic_matches(f, topic) for f in topic_filters):
+                    client.send(packet(PUBLISH, 1, encode_str(topic.encode()) + payload))
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = body.u16()
+            while body.more():
+                client.subscriptions.discard(body.str())
+            client.send(packet(UNSUBACK, 0, struct.pack("!H", packet_id)))
+        elif packet_type == PINGREQ:
+            client.send(packet(PINGRESP, 0))
+        elif packet_type == DISCONNECT:
+            return True
+        return False
+
+
+async def serve(host, port):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle, host, port)
+    logger.info(f"MQTT broker listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimal MQTT broker for local tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
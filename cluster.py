@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import socket
+import threading
+import zlib
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+def stable_hash(value: str) -> int:
+    return zlib.crc32(value.encode())
+
+
+class ClusterNode:
+    """Shard leadership of one Eplumber node, coordinated over MQTT.
+
+    Rules are split in shards. Every node publishes a retained heartbeat; the
+    leader of a shard is the live node ranked first by rendezvous hashing, which
+    all nodes compute the same way. The leader publishes a retained claim on the
+    shard and only evaluates and fires its rules once its claim is echoed back
+    by the broker, one heartbeat after, so that the previous leader has stepped
+    down. The claim also carries the rules already fired, so a new leader does
+    not repeat their actions.
+    """
+
+    def __init__(self, cfg, rules, node_id=None):
+        self.cfg = cfg
+        self.node_id = node_id or cfg.node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.prefix = f"eplumber/cluster/{cfg.name}"
+        self.timeout = 3 * cfg.heartbeat
+        # Rules commanding the same device share a shard, so that a single
+        # node tracks the commands sent to it
+        keys: dict[str, list[str]] = {}
+        for rule in rules:
+            keys.setdefault(rule.action.target_key, []).append(self._key(rule))
+        self.target_shards = {
+            target: stable_hash(min(target_keys)) % cfg.shards
+            for target, target_keys in keys.items()
+        }
+        self.shard_rules: dict[int, list] = {shard: [] for shard in range(cfg.shards)}
+        for rule in rules:
+            self.shard_rules[self.shard_of(rule)].append(rule)
+        self.client = None
+        self._started = monotonic()
+        self.seen: dict[str, float] = {}
+        self.claims: dict[int, dict] = {}
+        self._claimed_at: dict[int, float] = {}
+        # Replaced, never mutated: read without lock by the rules loop
+        self.owned: frozenset[int] = frozenset()
+        self._lock = threading.Lock()
+
+    def _key(self, rule) -> str:
+        if self.cfg.partition == "topic" and rule.tests:
+            return min(test.sensor.route or test.sensor.name for test in rule.tests)
+        return rule.name
+
+    def shard_of(self, rule) -> int:
+        return self.target_shards[rule.action.target_key]
+
+    def owns(self, rule) -> bool:
+        return self.shard_of(rule) in self.owned
+
+    def leader(self, shard, alive):
+        return max(alive, key=lambda node: stable_hash(f"{node}/{shard}"))
+
+    def _topic(self, *parts):
+        return "/".join((self.prefix, *map(str, parts)))
+
+    def attach(self, client):
+        """Register callbacks and last will, before the client connects"""
+        self.client = client
+        # Wait for the retained heartbeats of other nodes before claiming
+        self._started = monotonic()
+        # An empty retained message removes the heartbeat of a lost node
+        client.will_set(self._topic("nodes", self.node_id), b"", retain=True)
+        client.message_callback_add(self._topic("#"), self.on_message)
+        on_connect = client.on_connect
+
+        def on_cluster_connect(client, userdata, flags, reason_code, properties):
+            on_connect(client, userdata, flags, reason_code, properties)
+            if not reason_code.is_failure:
+                client.subscribe(self._topic("#"))
+
+        client.on_connect = on_cluster_connect
+
+    def on_message(self, client, userdata, message):
+        # paho re-raises callback errors, which would stop the network loop
+        try:
+            self._handle(message)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignore invalid cluster message on {message.topic}: {e!r}")
+
+    def _handle(self, message):
+        kind, _, key = message.topic.removeprefix(self.prefix + "/").partition("/")
+        payload = json.loads(message.payload) if message.payload else None
+        if payload is not None and not isinstance(payload, dict):
+            raise TypeError(f"expected an object, got {type(payload).__name__}")
+        if kind == "shards" and payload is not None:
+            if not isinstance(payload.get("leader"), str):
+                raise KeyError("leader")
+            if not isinstance(payload.get("epoch"), int):
+                raise KeyError("epoch")
+            if not isinstance(payload.get("fired", []), list):
+                raise TypeError("fired is not a list")
+        with self._lock:
+            if kind == "nodes":
+                if payload is None:
+                    self.seen.pop(key, None)
+                else:
+                    self.seen[key] = monotonic()
+            elif kind == "shards" and key.isdigit():
+                shard = int(key)
+                previous = self.claims.get(shard)
+                if payload is None:
+                    self.claims.pop(shard, None)
+                    return
+                self.claims[shard] = payload
+                if payload["leader"] != self.node_id:
+                    # Step down at once, the new leader waits a heartbeat
+                    self.owned = self.owned - {shard}
+                elif previous is None or previous["leader"] != self.node_id:
+                    self._claimed_at[shard] = monotonic()
+
+    def _publish(self, topic, payload):
+        self.client.publish(topic, json.dumps(payload), retain=True)
+
+    def tick(self, now=None):
+        """Send heartbeat, claim shards this node should lead and update owned"""
+        now = monotonic() if now is None else now
+        if self.client is None:
+            return
+        self._publish(self._topic("nodes", self.node_id), {"node": self.node_id})
+        with self._lock:
+            # Own heartbeat echoed by the broker, others see this node alive.
+            # Step down a heartbeat before they time it out and take over.
+            echoed = self.seen.get(self.node_id)
+            lease = self.timeout - self.cfg.heartbeat
+            if not self.client.is_connected() or echoed is None or now - echoed >= lease:
+                if self.owned:
+                    logger.warning(f"Node {self.node_id} lost the broker, steps down")
+                self.owned = frozenset()
+                return
+            alive = [node for node, seen in self.seen.items() if now - seen < self.timeout]
+            owned = set()
+            for shard, rules in self.shard_rules.items():
+                claim = self.claims.get(shard)
+                if claim is None or claim["leader"] != self.node_id:
+                    warm = now - self._started >= self.timeout
+                    if warm and self.leader(shard, alive) == self.node_id:
+                        self._claim(shard, claim)
+                    continue
+                if now - self._claimed_at.get(shard, now) < self.cfg.heartbeat:
+                    # Let the previous leader see the claim and step down
+                    continue
+                owned.add(shard)
+                if shard not in self.owned:
+                    self._take_over(shard, claim, now)
+                fired = sorted(rule.name for rule in rules if rule.fired)
+                if fired != claim.get("fired", []):
+                    self._publish(self._topic("shards", shard), claim | {"fired": fired})
+            self.owned = frozenset(owned)
+
+    def _claim(self, shard, claim):
+        epoch = claim["epoch"] + 1 if claim else 1
+        fired = claim.get("fired", []) if claim else []
+        logger.info(f"Node {self.node_id} claims shard {shard} (epoch {epoch})")
+        payload = {"leader": self.node_id, "epoch": epoch, "fired": fired}
+        self._publish(self._topic("shards", shard), payload)
+
+    def _take_over(self, shard, claim, now):
+        logger.info(f"Node {self.node_id} leads shard {shard}")
+        fired = set(claim.get("fired", []))
+        for rule in self.shard_rules[shard]:
+            rule.mark_fired(now if rule.name in fired else None)
+
+    def status(self) -> dict:
+        with self._lock:
+            now = monotonic()
+            return {
+                "node_id": self.node_id,
+                "nodes": sorted(
+                    node for node, seen in self.seen.items() if now - seen < self.timeout
+                ),
+                "owned_shards": sorted(self.owned),
+                "leaders": {shard: claim["leader"] for shard, claim in self.claims.items()},
+            }
@@ -1,13 +1,16 @@
+import asyncio
 import json
 import logging
 import threading
 from pathlib import Path
-from time import sleep
+from time import monotonic, sleep
+from typing import Literal
 
 import appdirs
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 
 import models
+from cluster import ClusterNode
 from notification import send_startup_notification
 from web_api import WebAPI
 
@@ -19,19 +22,30 @@ CFG_FILENAME = "eplumber.json"
 class Eplumber(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
-    sensord: models.SensorD = models.SensorD()
+    # Factories: sensors hold locks that cannot be deep copied
+    sensord: models.SensorD = Field(default_factory=models.SensorD)
     config: models.Config | None = None
     rules: list[models.Rule] = []
+    conditions: models.ConditionGraph | None = None
+    commands: models.CommandTracker = Field(default_factory=models.CommandTracker)
     http_sensors: list[models.HttpSensor] = []
     _http_timer: threading.Timer | None = None
     _rules_thread: threading.Thread | None = None
-    _cached_rules_data: list = []
+    # Replaced on each rules pass, never mutated
+    _cached_rules_data: tuple = ()
     web_api: WebAPI | None = None
     _config_path: Path | None = None
     log_level: str = "info"
+    runtime: Literal["threads", "asyncio"] = "threads"
+    port: int = 8000
+    node_id: str | None = None
+    cluster: ClusterNode | None = None
+    _cluster_timer: threading.Timer | None = None
+    _expiry_timer: threading.Timer | None = None
+    _cluster_rules: tuple = (frozenset(), [], [])
 
-    def __init__(self, log_level="info", **data):
-        super().__init__(log_level=log_level, **data)
+    def __init__(self, log_level="info", runtime="threads", **data):
+        super().__init__(log_level=log_level, runtime=runtime, **data)
 
     def get_config(self):
         cfg_json = None
@@ -48,6 +62,12 @@ class Eplumber(BaseModel):
 
         cfg_json = self._convert_numeric_strings(cfg_json)
         self._load_config_data(cfg_json)
+        if self.runtime == "asyncio":
+            asyncio.run(self._run_async())
+            return
+        self.config.mqtt.set_client(self.sensord, cluster=self.cluster)
+        self._start_cluster()
+        self._expire_sensors()
         self._start_http_polling()
         self._start_rule_polling()
         self._start_web_api()
@@ -82,6 +102,8 @@ class Eplumber(BaseModel):
         self.sensord = models.SensorD()
         self.rules = []
         self.http_sensors = []
+        self.commands = models.CommandTracker()
+        self.cluster = None
 
         self.config = models.Config(**cfg_json)
         for s in self.config.sensors:
@@ -90,21 +112,28 @@ class Eplumber(BaseModel):
                 self.http_sensors.append(sensor)
 
         action_d = {a.name: a for a in self.config.actions}
+        self.conditions = models.ConditionGraph(self.sensord)
         for cfg_rule in self.config.rules:
-            tests = []
-            for sensor_name, op, value in cfg_rule.tests:
-                test = models.Test(sensor=self.sensord[sensor_name], op=op, value=value)
-                tests.append(test)
+            # Top level tests are an implicit "all" group
+            condition = self.conditions.build({"all": cfg_rule.tests}, cfg_rule.hysteresis)
+            tests = list({test.key: test for test in condition.leaves()}.values())
             # Set active to True if not specified or empty
             active = cfg_rule.active if cfg_rule.active is not None else True
             rule = models.Rule(
                 name=cfg_rule.name,
                 tests=tests,
+                condition=condition,
                 action=action_d[cfg_rule.action],
                 active=active,
+                min_duration=cfg_rule.min_duration,
+                reassert=cfg_rule.reassert,
             )
             self.rules.append(rule)
 
+        if self.config.cluster:
+            self.cluster = ClusterNode(self.config.cluster, self.rules, self.node_id)
+            logger.info(f"Cluster node {self.cluster.node_id}")
+
         # Set web_api reference and recipients for all actions
         recipients = self.config.global_.recipients if self.config.global_ else []
         for rule in self.rules:
@@ -112,8 +141,6 @@ class Eplumber(BaseModel):
                 rule.action.set_web_api(self.web_api)
             rule.action.set_recipients(recipients)
 
-        self.config.mqtt.set_client(self.sensord)
-
         # Send startup notification
         if recipients:
             send_startup_notification(recipients)
@@ -131,60 +158,105 @@ class Eplumber(BaseModel):
         if self.http_sensors:
             self._poll_http_sensors()
 
+    def _expire_sensors(self):
+        """Expire windows and stale sensors even when no rule reads them"""
+        try:
+            self.sensord.expire()
+        except Exception as e:
+            logger.error(f"Sensor expiry failed: {e}")
+        self._expiry_timer = threading.Timer(1.0, self._expire_sensors)
+        self._expiry_timer.daemon = True
+        self._expiry_timer.start()
+
+    def _test_result(self, test):
+        current_value = test.sensor.mean
+        if isinstance(test.value, int | float | str | bool):
+            safe_test_value = test.value
+        else:
+            safe_test_value = str(test.value)
+        if isinstance(current_value, int | float | str | bool) or current_value is None:
+            safe_current_value = (
+                round(current_value, 2)
+                if isinstance(current_value, float)
+                else current_value
+            )
+        else:
+            safe_current_value = str(current_value)
+        return {
+            "sensor_name": str(test.sensor.name),
+            "operator": str(test.op),
+            "value": safe_test_value,
+            "current_sensor_value": safe_current_value,
+            "passes": test.passes,
+        }
+
+    def _tick_cluster(self):
+        try:
+            self.cluster.tick()
+        except Exception as e:
+            logger.error(f"Cluster heartbeat failed: {e}")
+        self._cluster_timer = threading.Timer(
+            self.config.cluster.heartbeat, self._tick_cluster
+        )
+        self._cluster_timer.start()
+
+    def _start_cluster(self):
+        if self.cluster:
+            self._tick_cluster()
+
+    def _owned_rules(self):
+        """Rules of the shards led by this node, with their condition nodes"""
+        if not self.cluster:
+            return self.rules, None
+        owned, rules, nodes = self._cluster_rules
+        if owned != self.cluster.owned:
+            owned = self.cluster.owned
+            rules = [rule for rule in self.rules if self.cluster.shard_of(rule) in owned]
+            nodes = self.conditions.reachable(rule.condition for rule in rules)
+            self._cluster_rules = (owned, rules, nodes)
+        return rules, nodes
+
+    def _evaluate_rules(self):
+        """Evaluate all rules, cache results and return the rules to fire"""
+        result = []
+        to_fire = []
+        rules, nodes = self._owned_rules()
+        self.sensord.expire()
+        # Each shared condition node is evaluated once for all rules
+        self.conditions.evaluate(nodes)
+        test_results = {}
+        now = monotonic()
+        for rule in rules:
+            rule_tests = []
+            for test in rule.tests:
+                try:
+                    if test.key not in test_results:
+                        test_results[test.key] = self._test_result(test)
+                    rule_tests.append(test_results[test.key])
+                except Exception as e:
+                    logger.error(f"Error evaluating test for rule {rule.name}: {e}")
+                    continue
+            all_tests_pass = rule.condition.passes is True
+            if rule.should_fire(now) and rule.claim(self.commands, now):
+                to_fire.append(rule)
+            rule_result = {
+                "action_name": f"{rule.name} ⇒ {rule.action.name}",
+                "condition": str(rule.condition),
+                "tests": rule_tests,
+                "all_tests_pass": all_tests_pass,
+                "active": rule.active,
+            }
+            result.append(rule_result)
+        # Cache the results for web API
+        self._cached_rules_data = tuple(result)
+        return to_fire
+
     def _check_rules_loop(self):
         while True:
-            result = []
-            for rule in self.rules:
-                rule_tests = []
-                for test in rule.tests:
-                    try:
-                        sensor_name = str(test.sensor.name)
-                        operator_str = str(test.op)
-                        test_value = test.value
-                        current_value = test.sensor.mean
-                        if current_value is not None and test.operator:
-                            passes = bool(test.operator(current_value, test_value))
-                        else:
-                            passes = False
-                        if isinstance(test_value, int | float | str | bool):
-                            safe_test_value = test_value
-                        else:
-                            safe_test_value = str(test_value)
-                        if (
-                            isinstance(current_value, int | float | str | bool)
-                            or current_value is None
-                        ):
-                            safe_current_value = (
-                                round(current_value, 2)
-                                if isinstance(current_value, float)
-                                else current_value
-                            )
-                        else:
-                            safe_current_value = str(current_value)
-                        test_result = {
-                            "sensor_name": sensor_name,
-                            "operator": operator_str,
-                            "value": safe_test_value,
-                            "current_sensor_value": safe_current_value,
-                            "passes": passes,
-                        }
-                        rule_tests.append(test_result)
-                    except Exception as e:
-                        logger.error(f"Error evaluating test for rule {rule.name}: {e}")
-                        continue
-                all_tests_pass = bool(all(t["passes"] for t in rule_tests))
-                if all_tests_pass and rule.active:
-                    rule.action.do(rule)
-                    sleep(5)
-                rule_result = {
-                    "action_name": f"{rule.name} ⇒ {rule.action.name}",
-                    "tests": rule_tests,
-                    "all_tests_pass": all_tests_pass,
-                    "active": rule.active,
-                }
-                result.append(rule_result)
-            # Cache the results for web API
-            self._cached_rules_data = result
+            for rule in self._evaluate_rules():
+                if not rule.action.do(rule):
+                    rule.release(self.commands)
+                sleep(5)
             sleep(1)
 
     def _start_rule_polling(self):
@@ -198,9 +270,67 @@ class Eplumber(BaseModel):
         if not self.web_api:
             self.web_api = WebAPI(self)
 
-            self.web_api.start_server(log_level=self.log_level)
-            logger.info("🌐 Web interface available at http://localhost:8000")
+            self.web_api.start_server(port=self.port, log_level=self.log_level)
+            logger.info(f"🌐 Web interface available at http://localhost:{self.port}")
 
         # Set web_api reference for all actions
         for rule in self.rules:
             rule.action.set_web_api(self.web_api)
+
+    async def _poll_http_sensors_task(self):
+        while True:
+            for sensor in self.http_sensors:
+                try:
+                    # requests is blocking, only the request leaves the loop
+                    data = await asyncio.to_thread(sensor.fetch)
+                    sensor.add(data)
+                except Exception as e:
+                    logger.error(f"Error polling HTTP sensor {sensor.name}: {e}")
+                    sensor.connected = False
+            await asyncio.sleep(10.0)
+
+    async def _expire_sensors_task(self):
+        while True:
+            try:
+                self.sensord.expire()
+            except Exception as e:
+                logger.error(f"Sensor expiry failed: {e}")
+            await asyncio.sleep(1.0)
+
+    async def _cluster_task(self):
+        while True:
+            try:
+                self.cluster.tick()
+            except Exception as e:
+                logger.error(f"Cluster heartbeat failed: {e}")
+            await asyncio.sleep(self.config.cluster.heartbeat)
+
+    async def _check_rules_task(self):
+        while True:
+            for rule in self._evaluate_rules():
+                if not await asyncio.to_thread(rule.action.do, rule):
+                    rule.release(self.commands)
+                await asyncio.sleep(5)
+            await asyncio.sleep(1)
+
+    async def _run_async(self):
+        """Run MQTT, HTTP polling, rules and web API on a single event loop"""
+        self.config.mqtt.set_client(
+            self.sensord, asyncio.get_running_loop(), cluster=self.cluster
+        )
+        tasks = [asyncio.create_task(self._expire_sensors_task())]
+        if self.cluster:
+            tasks.append(asyncio.create_task(self._cluster_task()))
+        if self.http_sensors:
+            tasks.append(asyncio.create_task(self._poll_http_sensors_task()))
+        if self.rules:
+            tasks.append(asyncio.create_task(self._check_rules_task()))
+        self.web_api = WebAPI(self)
+        for rule in self.rules:
+            rule.action.set_web_api(self.web_api)
+        logger.info(f"🌐 Web interface available at http://localhost:{self.port}")
+        try:
+            await self.web_api.serve(port=self.port, log_level=self.log_level)
+        finally:
+            for task in tasks:
+                task.cancel()
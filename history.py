@@ -0,0 +1,170 @@
+import atexit
+import json
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from time import monotonic, time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    action TEXT NOT NULL,
+    route TEXT NOT NULL,
+    rule TEXT,
+    sensors TEXT,
+    status INTEGER,
+    latency REAL,
+    error TEXT
+);
+-- Pages are ordered by (time, id), these indexes avoid sorting the results
+CREATE INDEX IF NOT EXISTS actions_time ON actions (time, id);
+CREATE INDEX IF NOT EXISTS actions_action ON actions (action, time, id);
+CREATE INDEX IF NOT EXISTS actions_rule ON actions (rule, time, id);
+"""
+
+INSERT = """
+INSERT INTO actions (time, action, route, rule, sensors, status, latency, error)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+MAX_LIMIT = 1000
+
+
+def parse_time(value: str | None) -> float | None:
+    """Epoch seconds or ISO 8601 date to epoch seconds"""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def parse_cursor(value: str | None) -> tuple[float, int] | None:
+    """next_cursor value, "time:id", to the position of the last action returned"""
+    if value is None or value == "":
+        return None
+    time_, _, id_ = value.rpartition(":")
+    return float(time_), int(id_)
+
+
+class ActionHistory:
+    """Actions stored in SQLite, written in batches by a background thread"""
+
+    def __init__(self, path: Path, batch_size=50, flush_interval=1.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+        self._queue: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(self, action, route, rule=None, status=None, latency=None, error=None):
+        sensors = None
+        if rule is not None:
+            sensors = json.dumps(
+                {test.sensor.name: test.sensor.mean for test in rule.tests}
+            )
+        self._queue.put(
+            (
+                time(),
+                action,
+                route,
+                rule.name if rule is not None else None,
+                sensors,
+                status,
+                latency,
+                error,
+            )
+        )
+
+    def _write_loop(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            deadline = monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - monotonic(), 0)))
+                except queue.Empty:
+                    break
+            stop = None in batch
+            rows = [row for row in batch if row is not None]
+            try:
+                with conn:
+                    conn.executemany(INSERT, rows)
+            except sqlite3.Error as e:
+                logger.error(f"Could not write {len(rows)} actions to history: {e}")
+        conn.close()
+
+    def close(self):
+        """Flush pending actions"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+    def query(
+        self, limit=100, cursor=None, action=None, rule=None, since=None, until=None
+    ) -> dict:
+        """Most recent actions first, older pages are fetched with next_cursor.
+
+        Pages are keyed on (time, id) so that a time range is read in index
+        order, cursor is the (time, id) of the last action of the previous page.
+        """
+        limit = max(1, min(limit, MAX_LIMIT))
+        where, params = [], []
+        for clause, value in (
+            ("(time, id) < (?, ?)", cursor),
+            ("action = ?", action),
+            ("rule = ?", rule),
+            ("time >= ?", since),
+            ("time < ?", until),
+        ):
+            if value is not None:
+                where.append(clause)
+                params.extend(value if isinstance(value, tuple) else (value,))
+        sql = "SELECT id, time, action, route, rule, sensors, status, latency, error"
+        sql += " FROM actions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY time DESC, id DESC LIMIT ?"
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql, (*params, limit + 1)).fetchall()
+        actions = []
+        for id_, time_, name, route, rule_, sensors, status, latency, error in rows[:limit]:
+            actions.append(
+                {
+                    "id": id_,
+                    "time": time_,
+                    "timestamp": datetime.fromtimestamp(time_).strftime(
+                        "%Y-%m-%d %H:%M:%S"
+                    ),
+                    "name": name,
+                    "route": route,
+                    "rule": rule_,
+                    "sensors": json.loads(sensors) if sensors else None,
+                    "status": status,
+                    "latency": latency,
+                    "error": error,
+                }
+            )
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = f"{actions[-1]['time']!r}:{actions[-1]['id']}"
+        return {"actions": actions, "next_cursor": next_cursor}
@@ -24,12 +24,24 @@ def main():
         default="info",
         help="Set the logging level (default: info)",
     )
+    parser.add_argument(
+        "--runtime",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="Run MQTT, rules and web API in threads or on one asyncio loop",
+    )
+    parser.add_argument(
+        "--port", type=int, default=8000, help="Web interface port (default: 8000)"
+    )
+    parser.add_argument("--node-id", help="Cluster node id (default: hostname-pid)")
 
     args = parser.parse_args()
     log_level = get_log_level(args.loglevel)
 
     logging.basicConfig(level=log_level)
-    e = Eplumber(log_level=args.loglevel)
+    e = Eplumber(
+        log_level=args.loglevel, runtime=args.runtime, port=args.port, node_id=args.node_id
+    )
     e.get_config()
 
 
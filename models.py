@@ -1,11 +1,15 @@
 import datetime
+import heapq
+import itertools
 import json
 import logging
 import operator
 import statistics
-from collections import deque
+import threading
+import time
 from collections.abc import Callable
-from typing import Literal
+from typing import Any, Literal
+from urllib.parse import urlsplit
 
 import paho.mqtt.client as mqtt_client
 import requests
@@ -42,28 +46,113 @@ class Sensor(BaseModel):
     connected: bool = False
     ready: bool = False
     value_list_length: int = 5
-    values: deque[float | int | bool | str] | None = None
-
-    def model_post_init(self, __context) -> None:
-        if self.values is None:
-            self.values = deque(maxlen=self.value_list_length)
+    window_seconds: float | None = Field(
+        None, gt=0, title="Keep samples of the last seconds instead of a sample count"
+    )
+    max_age: float | None = Field(
+        None, gt=0, title="Seconds without sample before the sensor is stale"
+    )
+    stale: bool = False
+    # (monotonic time, wall clock time, value), replaced on each change and never
+    # mutated: readers get a consistent snapshot. Ages and deadlines use the
+    # monotonic time so that clock steps neither purge nor stale the samples.
+    samples: tuple[tuple[float, float, float | int | bool | str], ...] = ()
+    _revision: int = PrivateAttr(default=0)
+    # Monotonic time of the last sample, kept when the window drops it
+    _received: float | None = PrivateAttr(default=None)
+    _deadline: float | None = PrivateAttr(default=None)
+    _expiry: "ExpiryHeap | None" = PrivateAttr(default=None)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
 
     def __str__(self):
         return str(self.name)
 
     @property
-    def mean(self) -> float | int | bool | str | None:
-        if not self.values:
+    def revision(self):
+        """Changes whenever the sensor mean may have changed"""
+        return self._revision
+
+    @property
+    def values(self) -> list[float | int | bool | str]:
+        return [value for _, _, value in self.samples]
+
+    @property
+    def timestamp(self) -> float | None:
+        """Wall clock time of the last sample"""
+        if not self.samples:
+            return None
+        return self.samples[-1][1]
+
+    def _mean(self, values):
+        if not values:
             return None
         if self.return_type == "bool":
-            return self.values[-1]
-        return float(statistics.mean(self.values))
+            return values[-1]
+        return float(statistics.mean(values))
+
+    @property
+    def mean(self) -> float | int | bool | str | None:
+        return self._mean(self.values)
+
+    def snapshot(self) -> dict:
+        """Sensor state computed from a single samples tuple"""
+        samples = self.samples
+        values = [value for _, _, value in samples]
+        return {
+            "name": self.name,
+            "route": self.route,
+            "type": self.type,
+            "return_type": self.return_type,
+            "connected": self.connected,
+            "ready": self.ready,
+            "stale": self.stale,
+            "timestamp": samples[-1][1] if samples else None,
+            "window_seconds": self.window_seconds,
+            "max_age": self.max_age,
+            "mean": self._mean(values),
+            "last": values[-1] if values else None,
+            "values": values,
+            "value_count": len(values),
+        }
 
     @property
     def last(self):
-        if not self.values:
+        if not self.samples:
             return None
-        return self.values[-1]
+        return self.samples[-1][2]
+
+    def next_deadline(self) -> float | None:
+        """Monotonic time when a sample leaves the window or the sensor gets stale"""
+        deadlines = []
+        if self.samples and self.window_seconds:
+            deadlines.append(self.samples[0][0] + self.window_seconds)
+        if self.max_age and self._received is not None and not self.stale:
+            deadlines.append(self._received + self.max_age)
+        return min(deadlines, default=None)
+
+    def expire(self, now=None) -> bool:
+        """Drop samples out of the time window and flag the sensor if stale"""
+        now = time.monotonic() if now is None else now
+        changed = False
+        if self.window_seconds:
+            cutoff = now - self.window_seconds
+            with self._lock:
+                samples = self.samples
+                start = 0
+                while start < len(samples) and samples[start][0] <= cutoff:
+                    start += 1
+                if start:
+                    self.samples = samples[start:]
+                    changed = True
+        if self.max_age and self._received is not None and not self.stale:
+            if now - self._received >= self.max_age:
+                logger.warning(f"Sensor {self.name} is stale")
+                self.stale = True
+                self.connected = False
+                changed = True
+        if changed:
+            self._revision += 1
+        return changed
 
     def _json_path_value(self, data):
         if isinstance(data, bytes) or isinstance(data, str):
@@ -103,9 +192,19 @@ class Sensor(BaseModel):
         if parsed_value is None:
             return None
         logging.debug(f"{self.name}.add({parsed_value}) mean:{self.mean}")
+        now = time.monotonic()
         self.connected = True
-        if self.values is not None:
-            self.values.append(parsed_value)
+        self.stale = False
+        with self._lock:
+            samples = self.samples + ((now, time.time(), parsed_value),)
+            if not self.window_seconds:
+                samples = samples[-self.value_list_length :]
+            self.samples = samples
+            self._received = now
+        self.expire(now)
+        self._revision += 1
+        if self._expiry is not None:
+            self._expiry.schedule(self)
         return parsed_value
 
 
@@ -116,11 +215,14 @@ class MqttSensor(Sensor):
 class HttpSensor(Sensor):
     type: Literal["http"] = "http"
 
+    def fetch(self):
+        response = requests.get(self.route, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
     def get_add_value(self):
         try:
-            response = requests.get(self.route, timeout=10)
-            response.raise_for_status()
-            data = response.json()
+            data = self.fetch()
             self.add(data)
             logging.debug(f"HTTP sensor {self.name}: {data}")
         except Exception as e:
@@ -133,10 +235,13 @@ class TimeSensor(Sensor):
     route: str = ""
     connected: bool = True
 
-    @property
-    def mean(self):
+    def _mean(self, values):
         return datetime.datetime.now().strftime("%H:%M")
 
+    @property
+    def revision(self):
+        return self.mean
+
 
 def add_sensor(sensor):
     if sensor.route in SENSORS:
@@ -144,10 +249,49 @@ def add_sensor(sensor):
     SENSORS[sensor.route] = sensor
 
 
+class ExpiryHeap:
+    """Single deadline heap driving window and staleness expiry of all sensors.
+
+    Each sensor has at most one live entry, the one matching its _deadline;
+    outdated entries are skipped when popped.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, Sensor]] = []
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, sensor):
+        deadline = sensor.next_deadline()
+        if deadline is None:
+            return
+        with self._lock:
+            if sensor._deadline is None or deadline < sensor._deadline:
+                sensor._deadline = deadline
+                heapq.heappush(self._heap, (deadline, next(self._counter), sensor))
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    return
+                deadline, _, sensor = heapq.heappop(self._heap)
+                if deadline != sensor._deadline:
+                    continue
+                sensor._deadline = None
+            sensor.expire(now)
+            self.schedule(sensor)
+
+
 class SensorD(BaseModel):
-    ss: dict[str, MqttSensor | HttpSensor | TimeSensor] = {
-        "time": TimeSensor(name="time", return_type="str")
-    }
+    ss: dict[str, MqttSensor | HttpSensor | TimeSensor] = Field(
+        default_factory=lambda: {"time": TimeSensor(name="time", return_type="str")}
+    )
+    _expiry: ExpiryHeap = PrivateAttr(default_factory=ExpiryHeap)
 
     def add(self, sensor_data: dict | MqttSensor | HttpSensor | TimeSensor):
         if isinstance(sensor_data, dict):
@@ -163,6 +307,7 @@ class SensorD(BaseModel):
         else:
             sensor = sensor_data
 
+        sensor._expiry = self._expiry
         self.ss[sensor.route] = sensor
         self.ss[sensor.name] = sensor
         return sensor
@@ -173,6 +318,9 @@ class SensorD(BaseModel):
     def add_value(self, route, value):
         self.ss[route].add(value)
 
+    def expire(self, now=None):
+        self._expiry.expire(now)
+
     def keys(self):
         return self.ss.keys()
 
@@ -189,11 +337,18 @@ VALID_OPERATOR = {
     "!=": operator.ne,
 }
 
+# Operators for which a hysteresis band widens the threshold once passing
+HYSTERESIS_SIGN = {"<": 1, "<=": 1, ">": -1, ">=": -1}
+
 
 class Test(BaseModel):
     sensor: MqttSensor | HttpSensor | TimeSensor
     op: str
+    hysteresis: float = 0
     _operator: Callable = PrivateAttr()
+    _revision: Any = PrivateAttr(default=None)
+    # None when unknown: no value yet
+    _passes: bool | None = PrivateAttr(default=None)
 
     @property
     def operator(self):
@@ -213,13 +368,172 @@ class Test(BaseModel):
         super().__init__(**data)
         self._operator = VALID_OPERATOR[self.op]
 
+    def __str__(self):
+        return f"{self.sensor.name} {self.op} {self.value}"
+
+    @property
+    def key(self):
+        return (
+            self.sensor.name,
+            self.op,
+            type(self.value).__name__,
+            self.value,
+            self.hysteresis,
+        )
+
+    @property
+    def threshold(self):
+        """Test value, moved by the hysteresis band while the test passes"""
+        if (
+            self._passes
+            and self.hysteresis
+            and self.op in HYSTERESIS_SIGN
+            and isinstance(self.value, int | float)
+        ):
+            return self.value + HYSTERESIS_SIGN[self.op] * self.hysteresis
+        return self.value
+
+    @property
+    def passes(self) -> bool | None:
+        return self._passes
+
+    def leaves(self):
+        yield self
+
+    def evaluate(self) -> bool:
+        """Compare the sensor mean only when the sensor has a new value"""
+        revision = self.sensor.revision
+        if revision == self._revision:
+            return self._passes
+        self._revision = revision
+        threshold = self.threshold
+        current_value = self.sensor.mean
+        # Unknown without value or with a stale one, even under not
+        if current_value is None or self.sensor.stale:
+            self._passes = None
+        else:
+            self._passes = bool(self._operator(current_value, threshold))
+        return self._passes
+
+
+class Group(BaseModel):
+    kind: Literal["all", "any", "not"]
+    children: list["Test | Group"]
+    _passes: bool | None = PrivateAttr(default=None)
+
+    def __str__(self):
+        if self.kind == "not":
+            return f"not ({self.children[0]})"
+        return (
+            "("
+            + f" {'and' if self.kind == 'all' else 'or'} ".join(
+                str(c) for c in self.children
+            )
+            + ")"
+        )
+
+    @property
+    def key(self):
+        return (self.kind, tuple(c.key for c in self.children))
+
+    @property
+    def passes(self) -> bool | None:
+        return self._passes
+
+    def leaves(self):
+        for child in self.children:
+            yield from child.leaves()
+
+    def evaluate(self) -> bool | None:
+        """Combine children results, children must be evaluated first.
+
+        Unknown (None) results follow three-valued logic: a group is unknown
+        unless its known children are enough to decide it.
+        """
+        results = [c.passes for c in self.children]
+        if self.kind == "not":
+            self._passes = None if results[0] is None else not results[0]
+        else:
+            decisive = self.kind == "any"
+            if decisive in results:
+                self._passes = decisive
+            elif None in results:
+                self._passes = None
+            else:
+                self._passes = not decisive
+        return self._passes
+
+
+class ConditionGraph:
+    """Hash-consed condition nodes shared by all rules.
+
+    Identical predicates and groups are built once, so a condition repeated in
+    several rules is evaluated once per pass whatever the number of rules.
+    """
+
+    def __init__(self, sensord):
+        self.sensord = sensord
+        # Insertion order is topological: children are added before parents
+        self.nodes: dict[tuple, Test | Group] = {}
+
+    def _intern(self, node):
+        return self.nodes.setdefault(node.key, node)
+
+    def build(self, spec, hysteresis=0) -> Test | Group:
+        if isinstance(spec, tuple | list):
+            sensor_name, op, value = spec
+            test = Test(
+                sensor=self.sensord[sensor_name], op=op, value=value, hysteresis=hysteresis
+            )
+            return self._intern(test)
+        ((kind, children),) = spec.items()
+        if kind == "not":
+            children = [children]
+        group = Group(kind=kind, children=[self.build(c, hysteresis) for c in children])
+        return self._intern(group)
+
+    def reachable(self, roots) -> list[Test | Group]:
+        """Nodes needed by the given roots, in evaluation order"""
+        needed = set()
+        stack = list(roots)
+        while stack:
+            node = stack.pop()
+            if node.key not in needed:
+                needed.add(node.key)
+                if isinstance(node, Group):
+                    stack.extend(node.children)
+        return [node for key, node in self.nodes.items() if key in needed]
+
+    def evaluate(self, nodes=None):
+        for node in self.nodes.values() if nodes is None else nodes:
+            try:
+                node.evaluate()
+            except Exception as e:
+                logger.error(f"Error evaluating condition {node}: {e}")
+                node._passes = None
+
 
 class Action(BaseModel):
     name: str
     route: str
+    target: str | None = Field(
+        None, title="Device commanded, default to route without query"
+    )
+    state: str | None = Field(None, title="Commanded state, default to route query")
     _web_api = None
     _recipients = None
 
+    @property
+    def target_key(self) -> str:
+        if self.target:
+            return self.target
+        url = urlsplit(self.route)
+        return f"{url.scheme}://{url.netloc}{url.path}"
+
+    @property
+    def state_key(self) -> str:
+        return self.state or urlsplit(self.route).query or self.route
+
     def set_web_api(self, web_api):
         self._web_api = web_api
 
@@ -229,30 +543,174 @@ class Action(BaseModel):
     def _send_email_notification(self, rule_context=None):
         send_action_notification(self._recipients, self.name, rule_context)
 
-    def do(self, rule_context=None):
+    def do(self, rule_context=None) -> bool:
+        """Send the action, tell if the device accepted it"""
         logger.info(f"Do {self.name}")
+        start = time.monotonic()
         try:
             response = requests.get(self.route)
+            latency = time.monotonic() - start
             if self._web_api:
-                self._web_api.log_action(self.name, self.route)
+                self._web_api.log_action(
+                    self.name, self.route, rule_context, response.status_code, latency
+                )
+            if not response.ok:
+                logger.error(f"Action {self.name} failed: {response.status_code}")
+                return False
             self._send_email_notification(rule_context)
             logger.debug(f"Action {self.name} executed: {response.status_code}")
+            return True
         except Exception as e:
             logger.error(f"Action {self.name} failed: {e}")
+            if self._web_api:
+                self._web_api.log_action(
+                    self.name,
+                    self.route,
+                    rule_context,
+                    latency=time.monotonic() - start,
+                    error=str(e),
+                )
+            return False
+
+
+class CommandTracker:
+    """Last state commanded to each target device.
+
+    The device may have changed since, switched by hand or by its own timer,
+    so a command identical to the last one is only redundant when it was sent
+    in the same rules pass, by another rule.
+    """
+
+    def __init__(self):
+        # target -> (state, since when, last sent)
+        self.last: dict[str, tuple[str, float, float]] = {}
+
+    def check(self, action, min_duration=0, now=None) -> Literal["send", "same", "wait"]:
+        """Tell if the action is not already sent in this pass and may be sent now"""
+        if action.target_key not in self.last:
+            return "send"
+        now = time.monotonic() if now is None else now
+        state, since, sent = self.last[action.target_key]
+        if state == action.state_key:
+            return "same" if sent == now else "send"
+        if now - since < min_duration:
+            return "wait"
+        return "send"
+
+    def record(self, action, now=None):
+        now = time.monotonic() if now is None else now
+        state, since, _ = self.last.get(action.target_key, (None, now, now))
+        if state != action.state_key:
+            since = now
+        self.last[action.target_key] = (action.state_key, since, now)
+
+    def forget(self, action):
+        """Drop a command that was not applied, its target state is unknown"""
+        if self.last.get(action.target_key, (None,))[0] == action.state_key:
+            del self.last[action.target_key]
 
 
 class Rule(BaseModel):
     name: str
     tests: list[Test]
+    condition: Test | Group
     action: Action
     active: bool = True
+    min_duration: float = 0
+    reassert: float | None = None
+    _fired_at: float | None = PrivateAttr(default=None)
+
+    @property
+    def fired(self) -> bool:
+        """Action already sent since the condition became true"""
+        return self._fired_at is not None
+
+    def mark_fired(self, at):
+        """Set when the action was sent, None to fire on the next true pass"""
+        self._fired_at = at
+
+    def should_fire(self, now) -> bool:
+        """Fire on false to true edges, then every reassert seconds if set"""
+        passes = self.condition.passes
+        if passes is False:
+            self._fired_at = None
+            return False
+        # Only a condition known to be true fires
+        if passes is None or not self.active:
+            return False
+        if self._fired_at is None:
+            return True
+        return self.reassert is not None and now - self._fired_at >= self.reassert
+
+    def claim(self, commands: CommandTracker, now) -> bool:
+        """Record the command and tell if the action must be sent.
+
+        The action is skipped when another rule sent the same command to its
+        target in this pass.
+        """
+        decision = commands.check(self.action, self.min_duration, now)
+        if decision == "wait":
+            # Retry on next passes until min_duration elapsed
+            return False
+        self._fired_at = now
+        if decision == "same":
+            logger.debug(f"Skip {self.action.name}: {self.action.target_key} already sent")
+            return False
+        # Recorded before sending so other rules of the pass see it
+        commands.record(self.action, now)
+        return True
+
+    def release(self, commands: CommandTracker):
+        """Undo a claim whose action failed, to send it again on the next pass"""
+        commands.forget(self.action)
+        self._fired_at = None
+
+
+TestSpec = tuple[str, str, float | str | int]
+
+
+def validate_condition(spec):
+    if isinstance(spec, tuple | list):
+        if len(spec) != 3:
+            raise ValueError(f"Test must be [sensor, operator, value]: {spec}")
+        if spec[1] not in VALID_OPERATOR:
+            raise ValueError(f"Invalid operator '{spec[1]}' in {spec}")
+        return
+    if not isinstance(spec, dict) or len(spec) != 1:
+        raise ValueError(f"Condition must be a test or a single key group: {spec}")
+    ((kind, children),) = spec.items()
+    if kind == "not":
+        validate_condition(children)
+    elif kind in ("all", "any"):
+        if not isinstance(children, list) or not children:
+            raise ValueError(f"'{kind}' group needs a non empty list of conditions")
+        for child in children:
+            validate_condition(child)
+    else:
+        raise ValueError(f"Unknown condition group '{kind}', use all, any or not")
 
 
 class ConfigRule(BaseModel):
     name: str
-    tests: list[tuple[str, str, float | str | int]]
+    tests: list[TestSpec | dict[str, Any]]
     action: str
     active: bool = True
+    hysteresis: float = Field(
+        0, ge=0, title="Band added to numeric thresholds once passing"
+    )
+    min_duration: float = Field(
+        0, ge=0, title="Seconds the target must keep its previous state before change"
+    )
+    reassert: float | None = Field(
+        None, gt=0, title="Seconds between repeated commands while the rule holds"
+    )
+
+    @field_validator("tests", mode="after")
+    @classmethod
+    def validate_tests(cls, v):
+        for spec in v:
+            validate_condition(spec)
+        return v
 
 
 class Mqtt(BaseModel):
@@ -262,8 +720,10 @@ class Mqtt(BaseModel):
     password: str
     model_config = ConfigDict(arbitrary_types_allowed=True)
     client: mqtt_client.Client | None = None
+    _asyncio_helper: mqtt.AsyncioHelper | None = PrivateAttr(default=None)
 
-    def set_client(self, sensord):
+    def set_client(self, sensord, loop=None, cluster=None):
+        """Connect the client, driven by a thread or by the given asyncio loop"""
         mqttc = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2)
         mqttc.on_connect = mqtt.on_connect
         mqttc.on_message = mqtt.on_message
@@ -271,20 +731,39 @@ class Mqtt(BaseModel):
         mqttc.user_data_set(sensord)
         if self.username:
             mqttc.username_pw_set(self.username, self.password)
+        if cluster is not None:
+            cluster.attach(mqttc)
+        if loop is not None:
+            # Socket callbacks must be set before connect
+            self._asyncio_helper = mqtt.AsyncioHelper(loop, mqttc)
         try:
-            mqttc.connect(self.host)
+            mqttc.connect(self.host, self.port)
         except OSError:
             raise ConnectionError(f"Could not connect to {self.host}")
-        mqttc.loop_start()  # threaded client interface
+        if loop is None:
+            mqttc.loop_start()  # threaded client interface
+        self.client = mqttc
 
 
 class Global(BaseModel):
     recipients: list[str] = []
+    history: str | None = Field(None, title="Action history database path")
+
+
+class Cluster(BaseModel):
+    name: str = Field("eplumber", title="Cluster name, used in coordination topics")
+    shards: int = Field(8, ge=1)
+    partition: Literal["rule", "topic"] = Field(
+        "rule", title="Shard rules by rule name or by their sensor routes"
+    )
+    heartbeat: float = Field(2, gt=0, title="Seconds between node heartbeats")
+    node_id: str | None = None
 
 
 class Config(BaseModel):
     global_: Global | None = Field(None, alias="global")
     mqtt: Mqtt
+    cluster: Cluster | None = None
     sensors: list[dict]
     actions: list[Action]
     rules: list[ConfigRule]
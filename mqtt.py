@@ -1,5 +1,8 @@
+import asyncio
 import logging
 
+import paho.mqtt.client as mqtt_client
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,3 +23,41 @@ def on_connect(client, sensord, flags, reason_code, properties):
     for route in sensord.keys():
         logger.info(f"Subscribe to {route}")
         client.subscribe(route)
+
+
+class AsyncioHelper:
+    """Drive a paho client from an asyncio loop instead of the loop_start thread"""
+
+    def __init__(self, loop, client, reconnect_delay=5):
+        self.loop = loop
+        self.client = client
+        self.reconnect_delay = reconnect_delay
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.misc = loop.create_task(self.misc_loop())
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        """Keepalive pings and reconnection, done by loop_start thread otherwise"""
+        while True:
+            if self.client.loop_misc() == mqtt_client.MQTT_ERR_NO_CONN:
+                await asyncio.sleep(self.reconnect_delay)
+                try:
+                    self.client.reconnect()
+                except OSError as e:
+                    logger.error(f"MQTT reconnection failed: {e}")
+                continue
+            await asyncio.sleep(1)
@@ -34,17 +34,14 @@ def send_action_notification(recipients, action_name, rule_context=None):
     body = f"Action '{action_name}' has been executed.\nTime: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
 
     if rule_context:
-        body += f"Rule: {rule_context.name}\n\nTest Results:\n"
+        body += f"Rule: {rule_context.name}\nCondition: {rule_context.condition}\n\n"
+        body += "Test Results:\n"
         for test in rule_context.tests:
             current_value = test.sensor.mean
             if isinstance(current_value, float):
                 current_value = round(current_value, 2)
-            passes = (
-                test.operator(current_value, test.value)
-                if current_value is not None
-                else False
-            )
-            status = "✅ PASS" if passes else "❌ FAIL"
+            passes = test.passes
+            status = {True: "✅ PASS", False: "❌ FAIL"}.get(passes, "❔ UNKNOWN")
             body += (
                 f"  {status} {test.sensor.name}: {current_value} {test.op} {test.value}\n"
             )
@@ -1,13 +1,14 @@
 import json
 import logging
 import threading
-from collections import deque
-from datetime import datetime
+from pathlib import Path
+import appdirs
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse
 import models
+from assets import IMMUTABLE, REVALIDATE, AssetPipeline
+from history import ActionHistory, parse_cursor, parse_time
 
 logger = logging.getLogger(__name__)
 
@@ -16,10 +17,13 @@ class WebAPI:
     def __init__(self, eplumber_instance):
         self.eplumber = eplumber_instance
         self.app = FastAPI(title="Eplumber Monitor", version="1.0.0")
-        self.action_history = deque(maxlen=100)
+        self.action_history = ActionHistory(self._history_path())
 
-        # Mount static files with cache control
-        self.app.mount("/static", StaticFiles(directory="static"), name="static")
+        self.assets = AssetPipeline(
+            "static",
+            pages={"/": "index.vue", "/config.html": "config.vue"},
+            aliases={"/favicon.ico": "favicon.svg", "/logo.svg": "logo.svg"},
+        )
 
         self._setup_routes()
 
@@ -35,29 +39,14 @@ class WebAPI:
                 unique_sensors.add(id(sensor))
 
                 try:
-                    values = list(sensor.values)
-                    sensor_data = {
-                        "name": sensor.name,
-                        "route": sensor.route,
-                        "type": sensor.type,
-                        "return_type": sensor.return_type,
-                        "connected": sensor.connected,
-                        "ready": sensor.ready,
-                        "mean": (
-                            round(sensor.mean, 2)
-                            if isinstance(sensor.mean, float)
-                            else sensor.mean
-                        ),
-                        "last": (
-                            round(sensor.last, 2)
-                            if isinstance(sensor.last, float)
-                            else sensor.last
-                        ),
-                        "values": [
-                            round(v, 2) if isinstance(v, float) else v for v in values
-                        ],
-                        "value_count": len(values),
-                    }
+                    sensor_data = sensor.snapshot()
+                    for key in ("mean", "last"):
+                        if isinstance(sensor_data[key], float):
+                            sensor_data[key] = round(sensor_data[key], 2)
+                    sensor_data["values"] = [
+                        round(v, 2) if isinstance(v, float) else v
+                        for v in sensor_data["values"]
+                    ]
                     sensors_data.append(sensor_data)
 
                 except Exception as e:
@@ -72,20 +61,7 @@ class WebAPI:
         async def get_sensor(sensor_name: str):
             try:
                 sensor = self.eplumber.sensord[sensor_name]
-                mean_value = sensor.mean
-                last_value = sensor.last if sensor.values else None
-                sensor_data = {
-                    "name": sensor.name,
-                    "route": sensor.route,
-                    "type": sensor.type,
-                    "return_type": sensor.return_type,
-                    "connected": sensor.connected,
-                    "ready": sensor.ready,
-                    "mean": mean_value,
-                    "last": last_value,
-                    "values": list(sensor.values),
-                    "value_count": len(sensor.values),
-                }
+                sensor_data = sensor.snapshot()
                 return JSONResponse(content=sensor_data)
             except KeyError:
                 raise HTTPException(status_code=404, detail="Sensor not found")
@@ -95,17 +71,51 @@ class WebAPI:
                 )
 
         @self.app.get("/api/actions/history")
-        async def get_action_history():
-            return JSONResponse(content={"actions": list(self.action_history)})
+        def get_action_history(
+            limit: int = 100,
+            cursor: str | None = None,
+            action: str | None = None,
+            rule: str | None = None,
+            since: str | None = None,
+            until: str | None = None,
+        ):
+            # Plain def: FastAPI runs the SQLite query in its thread pool
+            try:
+                since_time, until_time = parse_time(since), parse_time(until)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid time: {e}")
+            try:
+                position = parse_cursor(cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+            history = self.action_history.query(
+                limit=limit,
+                cursor=position,
+                action=action,
+                rule=rule,
+                since=since_time,
+                until=until_time,
+            )
+            return JSONResponse(content=history)
 
         @self.app.get("/api/rules")
         async def get_rules():
             try:
-                # Return cached rule evaluation results from the dedicated thread
-                return JSONResponse(content={"rules": self.eplumber._cached_rules_data})
+                # Return cached rule evaluation results from the rules loop
+                return JSONResponse(
+                    content={"rules": list(self.eplumber._cached_rules_data)}
+                )
             except Exception:
                 return JSONResponse(content={"rules": []})
 
+        @self.app.get("/api/cluster")
+        async def get_cluster():
+            if not self.eplumber.cluster:
+                return JSONResponse(
+                    content={"error": "Cluster mode disabled"}, status_code=404
+                )
+            return JSONResponse(content=self.eplumber.cluster.status())
+
         @self.app.get("/api/config")
         async def get_config():
             try:
@@ -156,45 +166,45 @@ class WebAPI:
                 return JSONResponse(content={"error": str(e)}, status_code=500)
 
         @self.app.get("/")
-        async def get_dashboard():
-            response = FileResponse("static/index.vue", media_type="text/html")
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-            return response
+        async def get_dashboard(request: Request):
+            return self.assets.pages["/"].response(request, REVALIDATE)
 
         @self.app.get("/config.html")
-        async def get_config_editor():
-            response = FileResponse("static/config.vue", media_type="text/html")
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-            return response
-
-        @self.app.get("/static/css/{filename}")
-        async def get_css(filename: str):
-            response = FileResponse(f"static/css/{filename}", media_type="text/css")
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-            return response
-
+        async def get_config_editor(request: Request):
+            return self.assets.pages["/config.html"].response(request, REVALIDATE)
+
+        @self.app.get("/assets/{name:path}")
+        async def get_asset(name: str, request: Request):
+            asset = self.assets.assets.get(name)
+            if asset is None:
+                raise HTTPException(status_code=404, detail="Asset not found")
+            return asset.response(request, IMMUTABLE)
+
+        # Unversioned urls, kept for external links
+        @self.app.get("/static/{path:path}")
         @self.app.get("/favicon.ico")
-        async def get_favicon():
-            return FileResponse("static/favicon.svg", media_type="image/svg+xml")
-
         @self.app.get("/logo.svg")
-        async def get_favicon():
-            return FileResponse("static/logo.svg", media_type="image/svg+xml")
-
-    def log_action(self, action_name: str, route: str):
-        self.action_history.append(
-            {
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "name": action_name,
-                "route": route,
-            }
-        )
+        async def get_static(request: Request):
+            asset = self.assets.legacy.get(request.url.path)
+            if asset is None:
+                raise HTTPException(status_code=404, detail="File not found")
+            return asset.response(request, REVALIDATE)
+
+    def _history_path(self):
+        config = self.eplumber.config
+        if config and config.global_ and config.global_.history:
+            return Path(config.global_.history)
+        return Path(appdirs.user_data_dir("eplumber")) / "history.sqlite3"
+
+    def log_action(
+        self, action_name: str, route: str, rule=None, status=None, latency=None, error=None
+    ):
+        self.action_history.add(action_name, route, rule, status, latency, error)
+
+    async def serve(self, host="0.0.0.0", port=8000, log_level="info"):
+        """Serve on the running event loop"""
+        config = uvicorn.Config(self.app, host=host, port=port, log_level=log_level)
+        await uvicorn.Server(config).serve()
 
     def start_server(self, host="0.0.0.0", port=8000, log_level="info"):
         def run_server():